@@ -1,21 +1,38 @@
+import atexit
+import base64
+import itertools
 import json
 import threading
 import time
 import paho.mqtt.client as mqtt
+import requests
 from flask import Flask, jsonify, request
+from flask.json.provider import DefaultJSONProvider
 from flask_cors import CORS
 import sys
 import os
 from dotenv import load_dotenv
-from queue import Queue, Empty
-import uuid
+from queue import Queue, Full, SimpleQueue
+from concurrent.futures import Future, TimeoutError as FutureTimeout
 import signal
+import socket
 import logging
+from collections import OrderedDict
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 load_dotenv()
 
 logging.basicConfig(
-    level=logging.INFO,
+    level=os.getenv("LOG_LEVEL", "INFO").upper(),
     format='[%(asctime)s] %(name)s - %(levelname)s - %(message)s'
 )
 logger = logging.getLogger(__name__)
@@ -23,114 +40,330 @@ logger = logging.getLogger(__name__)
 try:
     import sga
     import SandGrain_Credentials as credentials
+    sga.set_cloudflare_tokens(credentials.cloudflaretokens)
+    IOT_USER = credentials.iotusername
+    IOT_PASS = credentials.iotpassword
     logger.info("✓ SGA module loaded successfully")
 except ImportError as e:
     logger.error(f"✗ Failed to import modules: {e}")
     sys.exit(1)
 
+def pin_cpus():
+    """Restrict the process to the cores listed in PI_API_CPUS (e.g. "2,3")"""
+    cpus = os.getenv("PI_API_CPUS")
+    if not cpus:
+        return
+    try:
+        # Set before any worker threads start so they inherit the mask
+        os.sched_setaffinity(0, {int(c) for c in cpus.split(",")})
+        logger.info(f"Pinned to CPUs {cpus}")
+    except (AttributeError, ValueError, OSError) as e:
+        logger.warning(f"Could not pin to CPUs {cpus}: {e}")
+
+pin_cpus()
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Flask JSON provider backed by orjson (request.get_json and jsonify)"""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
 app = Flask(__name__)
+if orjson is not None:
+    app.json = OrjsonProvider(app)
+app.json.sort_keys = False
 CORS(app)
 
+def _json(data, status=200):
+    """JSON response, serialized with orjson when it is installed"""
+    if orjson is None:
+        return jsonify(data), status
+    return app.response_class(orjson.dumps(data), status=status, mimetype='application/json')
+
+def _raw_json(body, status=200):
+    """JSON response from an already serialized body"""
+    return app.response_class(body, status=status, mimetype='application/json')
+
+LED_PINS = [5, 6, 12]  # green, red, yellow
+
 def gpio_setup():
+    """Return a writer taking (green, red, yellow) levels, or None in mock mode"""
+    handle = None
+    try:
+        import lgpio
+        handle = lgpio.gpiochip_open(0)
+        lgpio.gpio_group_claim_output(handle, LED_PINS, [0, 0, 1])
+        logger.info("GPIO driven through lgpio")
+        # One group write updates all three pins; bit i drives LED_PINS[i]
+        return lambda levels: lgpio.gpio_group_write(
+            handle, LED_PINS[0], levels[0] | levels[1] << 1 | levels[2] << 2
+        )
+    except ImportError:
+        pass
+    except Exception as e:
+        logger.warning(f"lgpio setup failed ({e}) - falling back to RPi.GPIO")
+        # The chip may have opened before the claim failed (pins busy)
+        if handle is not None:
+            try:
+                lgpio.gpiochip_close(handle)
+            except Exception:
+                pass
+
     try:
         import RPi.GPIO as GPIO
         GPIO.setmode(GPIO.BCM)
-        GPIO.setup(5, GPIO.OUT)
-        GPIO.setup(6, GPIO.OUT)
-        GPIO.setup(12, GPIO.OUT)
-        GPIO.output(5, GPIO.LOW)
-        GPIO.output(6, GPIO.LOW)
-        GPIO.output(12, GPIO.HIGH)
-        return GPIO
+        GPIO.setup(LED_PINS, GPIO.OUT)
+        GPIO.output(LED_PINS, [GPIO.LOW, GPIO.LOW, GPIO.HIGH])
+        return lambda levels: GPIO.output(LED_PINS, levels)
     except ImportError:
         logger.warning("GPIO not available - mock mode")
         return None
 
-GPIO = gpio_setup()
+write_leds = gpio_setup()
+
+_LED_PATTERNS = {
+    "green": (1, 0, 0),
+    "red": (0, 1, 0),
+    "yellow": (0, 0, 1),
+    "off": (0, 0, 0),
+}
+
+_current_led = None
+_led_lock = threading.Lock()
 
 def set_led_status(status):
-    if GPIO:
-        GPIO.output(5, status == "green")
-        GPIO.output(6, status == "red")
-        GPIO.output(12, status == "yellow")
-
-command_queue = Queue()
-response_map = {}
-response_map_lock = threading.Lock()
+    global _current_led
+    if not write_leds:
+        return
+    if status not in _LED_PATTERNS:
+        status = "off"
+    # Jobs set yellow/green back to back; skip writes that change nothing
+    with _led_lock:
+        if status == _current_led:
+            return
+        write_leds(_LED_PATTERNS[status])
+        _current_led = status
+
+# Bounded so a stuck device sheds load instead of piling up jobs
+COMMAND_QUEUE_SIZE = int(os.getenv("COMMAND_QUEUE_SIZE", "32"))
+command_queue = Queue(maxsize=COMMAND_QUEUE_SIZE)
 job_start_times = {}
-JOB_MAX_TIME = 300
+_job_ids = itertools.count(1)  # next() on count is atomic under the GIL
+JOB_MAX_TIME = int(os.getenv("JOB_MAX_TIME", "300"))
+
+# Per-function wait limits for API and MQTT callers, overridable from .env
+JOB_TIMEOUT = int(os.getenv("JOB_TIMEOUT", "180"))
+JOB_TIMEOUTS = {
+    "status": int(os.getenv("STATUS_TIMEOUT", "10")),
+    "get_identity": JOB_TIMEOUT,
+    "get_cw": JOB_TIMEOUT,
+    "get_rw": JOB_TIMEOUT,
+    "authenticate": int(os.getenv("AUTH_TIMEOUT", "240")),
+}
+
+def _run_job(job_id, fn, payload):
+    job_start_times[job_id] = time.time()
+    logger.info("[Worker] Starting job %s: %s", job_id, fn)
+    
+    try:
+        handler = _DISPATCH.get(fn)
+        if handler:
+            result = handler(payload)
+        else:
+            result = {"success": False, "error": "Unknown function"}
+        
+        duration = time.time() - job_start_times[job_id]
+        logger.info("[Worker] ✓ Job %s completed in %.2fs", job_id, duration)
+        
+    except Exception as e:
+        duration = time.time() - job_start_times.get(job_id, time.time())
+        logger.error(f"[Worker] ✗ Job {job_id} failed after {duration:.2f}s: {e}")
+        result = {"success": False, "error": str(e)}
+    
+    finally:
+        job_start_times.pop(job_id, None)
+    
+    return result
+
+# Set once the startup scan has finished, whether or not it found devices
+_device_scan_done = threading.Event()
+
+def _device_pool_state():
+    if not _device_scan_done.is_set():
+        return "initializing"
+    return "ready" if sga._device_pool.devices else "no_devices"
 
 def serial_worker():
     logger.info("[Worker] Serial worker started - ZERO FAILURE MODE")
+    # Scan for devices now rather than inside the first request; device
+    # jobs queue behind the scan, everything else is served meanwhile
+    try:
+        sga._device_pool.initialize()
+    except Exception as e:
+        logger.error(f"[Worker] Device scan failed: {e}")
+    finally:
+        _device_scan_done.set()
     
     while True:
+        # Timeouts are enforced by the caller's Future, so just block
+        job_id, fn, payload, future = command_queue.get()
+
         try:
-            job_id, fn, payload = command_queue.get(timeout=1)
-            job_start_times[job_id] = time.time()
-            
-            logger.info(f"[Worker] Starting job {job_id}: {fn}")
-            
-            try:
-                if fn == "status":
-                    result = status_logic()
-                elif fn == "get_identity":
-                    result = get_identity_logic()
-                elif fn == "get_cw":
-                    result = get_cw_logic(payload.get("identity"))
-                elif fn == "get_rw":
-                    result = get_rw_logic(payload.get("cw"))
-                elif fn == "authenticate":
-                    result = authenticate_logic(
-                        payload.get("identity"),
-                        payload.get("cw"),
-                        payload.get("rw"),
-                        payload.get("transactionId")
-                    )
-                else:
-                    result = {"success": False, "error": "Unknown function"}
-                
-                duration = time.time() - job_start_times[job_id]
-                logger.info(f"[Worker] ✓ Job {job_id} completed in {duration:.2f}s")
-                
-            except Exception as e:
-                duration = time.time() - job_start_times.get(job_id, time.time())
-                logger.error(f"[Worker] ✗ Job {job_id} failed after {duration:.2f}s: {e}")
-                result = {"success": False, "error": str(e)}
-            
-            with response_map_lock:
-                response_map[job_id] = result
-                if job_id in job_start_times:
-                    del job_start_times[job_id]
-            
-            command_queue.task_done()
+            # The caller timed out and cancelled before the job was reached
+            if not future.set_running_or_notify_cancel():
+                logger.info("[Worker] Skipping cancelled job %s", job_id)
+                continue
+
+            future.set_result(_run_job(job_id, fn, payload))
             
-        except Empty:
-            current_time = time.time()
-            with response_map_lock:
-                stalled = [
-                    (jid, current_time - start_time)
-                    for jid, start_time in job_start_times.items()
-                    if current_time - start_time > JOB_MAX_TIME
-                ]
-                
-                for jid, duration in stalled:
-                    logger.error(f"[Worker] Job {jid} exceeded max time ({duration:.0f}s)")
-                    response_map[jid] = {
-                        "success": False,
-                        "error": f"Job exceeded maximum time ({JOB_MAX_TIME}s)"
-                    }
-                    del job_start_times[jid]
-        
         except Exception as e:
             logger.error(f"[Worker] Unexpected error: {e}")
 
+        finally:
+            command_queue.task_done()
+
+STALL_CHECK_INTERVAL = 30
+
+def _stall_watcher():
+    # Runs apart from serial_worker so the worker can block on the queue
+    while True:
+        time.sleep(STALL_CHECK_INTERVAL)
+        now = time.time()
+        for job_id, started in list(job_start_times.items()):
+            if now - started > JOB_MAX_TIME:
+                logger.warning("[Watcher] Job %s running for %.0fs", job_id, now - started)
+
 threading.Thread(target=serial_worker, daemon=True).start()
+threading.Thread(target=_stall_watcher, daemon=True).start()
+
+class DaemonExecutor:
+    """Minimal executor on daemon threads.
+
+    ThreadPoolExecutor joins its (non-daemon) workers at interpreter exit,
+    so one still waiting on a job would hold SIGTERM for minutes.
+    """
+
+    def __init__(self, max_workers, name):
+        self._jobs = SimpleQueue()
+        for i in range(max_workers):
+            threading.Thread(target=self._work, name=f"{name}-{i}", daemon=True).start()
+
+    def submit(self, fn, *args):
+        future = Future()
+        self._jobs.put((future, fn, args))
+        return future
+
+    def _work(self):
+        while True:
+            future, fn, args = self._jobs.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+# Only these touch the SGA serial device and must go through serial_worker;
+# the CyberRock-only jobs run concurrently on a separate pool
+_SERIAL_FUNCS = frozenset({"get_identity", "get_rw"})
+_cloud_executor = DaemonExecutor(max_workers=8, name="cloud")
+
+# ==================== IOT TOKEN CACHE ====================
+TOKEN_DEFAULT_TTL = 600
+TOKEN_REFRESH_MARGIN = 30
+
+_token_cache = {"token": None, "iotid": None, "expires_at": 0, "refreshing": False}
+_token_lock = threading.Lock()
+
+def _token_expiry(token):
+    """Monotonic expiry time from the JWT exp claim, or a conservative TTL"""
+    try:
+        claims = token.split('.')[1]
+        claims += '=' * (-len(claims) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(claims))['exp']
+        return time.monotonic() + (exp - time.time())
+    except Exception:
+        return time.monotonic() + TOKEN_DEFAULT_TTL
+
+def _store_token(token, iotid):
+    _token_cache.update(token=token, iotid=iotid, expires_at=_token_expiry(token))
+    logger.info("[Token] IoT access token refreshed")
+
+def _login_locked():
+    token, iotid = sga.do_cyberrock_iot_login(IOT_USER, IOT_PASS)
+    _store_token(token, iotid)
+    return token
+
+def _get_token():
+    with _token_lock:
+        token = _token_cache["token"]
+        remaining = _token_cache["expires_at"] - time.monotonic()
+        if token and remaining > TOKEN_REFRESH_MARGIN:
+            return token
+        if token and remaining > 0:
+            # Still valid: hand it out and renew in the background so the
+            # caller doesn't pay for the login round-trip
+            if not _token_cache["refreshing"]:
+                _token_cache["refreshing"] = True
+                _prefetch_executor.submit(_refresh_token)
+            return token
+        try:
+            return _login_locked()
+        except Exception as e:
+            # Our expiry is an estimate; if login is down, the old token may
+            # still be accepted. A 401 invalidates it and surfaces the error
+            if not token:
+                raise
+            logger.warning(f"[Token] Login failed, reusing expired token: {e}")
+            return token
+
+def _refresh_token():
+    # Log in without the lock so callers keep getting the current token
+    # meanwhile; only the cache update is locked
+    try:
+        token, iotid = sga.do_cyberrock_iot_login(IOT_USER, IOT_PASS)
+    except Exception as e:
+        logger.warning(f"[Token] Background refresh failed: {e}")
+        token = None
+    with _token_lock:
+        if token:
+            _store_token(token, iotid)
+        _token_cache["refreshing"] = False
+
+def _invalidate_token():
+    with _token_lock:
+        _token_cache.update(token=None, iotid=None, expires_at=0)
+
+def _with_token(call):
+    """Run call(token), re-logging in once if the cached token is rejected"""
+    try:
+        return call(_get_token())
+    except requests.HTTPError as e:
+        if e.response is None or e.response.status_code != 401:
+            raise
+        logger.warning("[Token] IoT access token rejected, logging in again")
+        _invalidate_token()
+        return call(_get_token())
+
+_prefetch_executor = DaemonExecutor(max_workers=1, name="token-prefetch")
+
+def _prefetch_token():
+    try:
+        _get_token()
+    except Exception as e:
+        logger.warning(f"[Token] Prefetch failed: {e}")
 
 def status_logic():
     return {"status": "ok", "message": "Raspberry Pi API is running"}
 
 def get_identity_logic():
     set_led_status('yellow')
+    # The next step of the flow (get_cw) needs a CyberRock token; log in
+    # while the device is being read so the two round-trips overlap
+    _prefetch_executor.submit(_prefetch_token)
     try:
         identity = sga.get_pccid()
         set_led_status('green')
@@ -146,17 +379,11 @@ def get_cw_logic(identity):
 
     set_led_status('yellow')
     try:
-        iotaccesstoken, _ = sga.do_cyberrock_iot_login(
-            credentials.cloudflaretokens,
-            credentials.iotusername,
-            credentials.iotpassword
-        )
-        cw, transactionId = sga.get_cyberrock_cw(
-            credentials.cloudflaretokens,
-            iotaccesstoken,
+        cw, transactionId = _with_token(lambda token: sga.get_cyberrock_cw(
+            token,
             identity,
             False
-        )
+        ))
         set_led_status('green')
         return {"success": True, "cw": cw, "transactionId": transactionId}
     except Exception as e:
@@ -164,14 +391,19 @@ def get_cw_logic(identity):
         logger.error(f"get_cw failed: {e}")
         raise
 
+def _cw_to_bytes(cw_hex):
+    cw_hex = cw_hex.removeprefix('0x')
+    if len(cw_hex) % 2:
+        cw_hex = '0' + cw_hex
+    return bytes.fromhex(cw_hex)
+
 def get_rw_logic(cw):
     if not cw:
         raise ValueError("CW is required")
 
     set_led_status('yellow')
     try:
-        cw_int = int(cw, 16)
-        rw = sga.do_rw_only(sga.intToList(cw_int))
+        rw = sga.do_rw_only(_cw_to_bytes(cw))
         set_led_status('green')
         return {"success": True, "rw": rw}
     except Exception as e:
@@ -180,31 +412,24 @@ def get_rw_logic(cw):
         raise
 
 def authenticate_logic(identity, cw, rw, transactionId):
-    if not all([identity, cw, rw, transactionId]):
+    if not (identity and cw and rw and transactionId):
         raise ValueError("All parameters required")
 
     set_led_status('yellow')
     try:
-        iotaccesstoken, _ = sga.do_cyberrock_iot_login(
-            credentials.cloudflaretokens,
-            credentials.iotusername,
-            credentials.iotpassword
-        )
-        sga.do_submit_rw(
-            credentials.cloudflaretokens,
-            iotaccesstoken,
+        _with_token(lambda token: sga.do_submit_rw(
+            token,
             identity,
             cw,
             rw,
             transactionId,
             False
-        )
-        auth_result, claim_id = sga.do_retrieve_result(
-            credentials.cloudflaretokens,
-            iotaccesstoken,
+        ))
+        auth_result, claim_id = _with_token(lambda token: sga.do_retrieve_result(
+            token,
             transactionId,
             False
-        )
+        ))
         set_led_status('green' if auth_result in ['CLAIM_ID', 'AUTH_OK'] else 'red')
         return {
             "success": auth_result in ['CLAIM_ID', 'AUTH_OK'],
@@ -216,178 +441,329 @@ def authenticate_logic(identity, cw, rw, transactionId):
         logger.error(f"authenticate failed: {e}")
         raise
 
-def enqueue_and_wait(fn, payload, timeout=300):
-    job_id = str(uuid.uuid4())
+_DISPATCH = {
+    "status": lambda p: status_logic(),
+    "get_identity": lambda p: get_identity_logic(),
+    "get_cw": lambda p: get_cw_logic(p.get("identity")),
+    "get_rw": lambda p: get_rw_logic(p.get("cw")),
+    "authenticate": lambda p: authenticate_logic(
+        p.get("identity"),
+        p.get("cw"),
+        p.get("rw"),
+        p.get("transactionId")
+    ),
+}
+
+class ServerBusy(Exception):
+    """The serial job queue is full"""
+
+def enqueue_and_wait(fn, payload, timeout=JOB_MAX_TIME):
+    job_id = next(_job_ids)
     
-    command_queue.put((job_id, fn, payload))
-    logger.info(f"[API] Enqueued job {job_id}: {fn}")
+    if fn in _SERIAL_FUNCS:
+        future = Future()
+        try:
+            command_queue.put_nowait((job_id, fn, payload, future))
+        except Full:
+            logger.warning("[API] Queue full, rejecting %s", fn)
+            raise ServerBusy("Server busy, retry later")
+    else:
+        future = _cloud_executor.submit(_run_job, job_id, fn, payload)
+    logger.info("[API] Enqueued job %s: %s", job_id, fn)
     
     start_time = time.time()
-    last_log = start_time
+    deadline = start_time + timeout
     
     while True:
-        with response_map_lock:
-            if job_id in response_map:
-                result = response_map.pop(job_id)
-                elapsed = time.time() - start_time
-                logger.info(f"[API] Job {job_id} completed in {elapsed:.2f}s")
-                return result
-        
-        elapsed = time.time() - start_time
-        if elapsed > timeout:
-            logger.error(f"[API] Job {job_id} timed out after {timeout}s")
-            return {
-                "success": False,
-                "error": f"Operation timed out after {timeout}s"
-            }
-        
-        if elapsed - (last_log - start_time) > 10:
-            logger.info(f"[API] Still waiting for job {job_id} ({elapsed:.0f}s)...")
-            last_log = time.time()
+        try:
+            result = future.result(timeout=min(10, max(0, deadline - time.time())))
+        except FutureTimeout:
+            elapsed = time.time() - start_time
+            if elapsed >= timeout:
+                future.cancel()
+                logger.error(f"[API] Job {job_id} timed out after {timeout}s")
+                return {
+                    "success": False,
+                    "error": f"Operation timed out after {timeout}s"
+                }
+            logger.info("[API] Still waiting for job %s (%.0fs)...", job_id, elapsed)
+            continue
         
-        time.sleep(0.5)
+        logger.info("[API] Job %s completed in %.2fs", job_id, time.time() - start_time)
+        return result
+
+HEALTH_CACHE_TTL = 1.0
+
+# (monotonic time, serialized body); swapped as one tuple so readers never
+# see a body from one refresh paired with the time of another
+_health_cache = (float("-inf"), None)
+_health_lock = threading.Lock()
+
+def _health_body():
+    health = {
+        "status": "ok",
+        "timestamp": time.time(),
+        "queue_size": command_queue.qsize(),
+        "pending_responses": command_queue.unfinished_tasks,
+        "active_jobs": len(job_start_times),
+        "mode": "ZERO_FAILURE",
+        "device_pool": _device_pool_state(),
+        "devices": []
+    }
+    
+    if sga._device_pool.initialized:
+        for device in sga._device_pool.devices:
+            health["devices"].append({
+                "id": device.device_id,
+                "port": device.serial_port,
+                "consecutive_failures": device.consecutive_failures,
+                "total_ops": device.total_operations,
+                "successful_ops": device.successful_operations,
+                "success_rate": f"{(device.successful_operations / device.total_operations * 100):.1f}%" 
+                    if device.total_operations > 0 else "N/A"
+            })
+    
+    return app.json.dumps(health)
 
 @app.route('/api/health', methods=['GET'])
 def api_health():
+    global _health_cache
     try:
-        health = {
-            "status": "ok",
-            "timestamp": time.time(),
-            "queue_size": command_queue.qsize(),
-            "pending_responses": len(response_map),
-            "active_jobs": len(job_start_times),
-            "mode": "ZERO_FAILURE",
-            "devices": []
-        }
-        
-        if sga._device_pool.initialized:
-            for device in sga._device_pool.devices:
-                health["devices"].append({
-                    "id": device.device_id,
-                    "port": device.serial_port,
-                    "consecutive_failures": device.consecutive_failures,
-                    "total_ops": device.total_operations,
-                    "successful_ops": device.successful_operations,
-                    "success_rate": f"{(device.successful_operations / device.total_operations * 100):.1f}%" 
-                        if device.total_operations > 0 else "N/A"
-                })
-        
-        return jsonify(health)
+        # Probes poll this every second; serve them all one snapshot
+        if time.monotonic() - _health_cache[0] >= HEALTH_CACHE_TTL:
+            with _health_lock:
+                if time.monotonic() - _health_cache[0] >= HEALTH_CACHE_TTL:
+                    _health_cache = (time.monotonic(), _health_body())
+        return _raw_json(_health_cache[1])
     except Exception as e:
-        return jsonify({"status": "error", "error": str(e)}), 500
+        return _json({"status": "error", "error": str(e)}, 500)
+
+# Constant replies are serialized once. A fresh Response is still built
+# per request because CORS adds headers to it in place
+_STATUS_BODY = app.json.dumps(status_logic())
+_MISSING_IDENTITY_BODY = app.json.dumps({"success": False, "error": "Missing identity parameter"})
+_MISSING_CW_BODY = app.json.dumps({"success": False, "error": "Missing cw parameter"})
 
 @app.route('/api/status', methods=['GET'])
 def api_status():
-    try:
-        return jsonify(enqueue_and_wait("status", {}, timeout=10))
-    except Exception as e:
-        logger.error(f"Status endpoint error: {e}")
-        return jsonify({"success": False, "error": str(e)}), 500
+    return _raw_json(_STATUS_BODY)
+
+def _missing_fields(data, fields):
+    """Required fields that are absent, empty or not strings"""
+    if not isinstance(data, dict):
+        return list(fields)
+    return [f for f in fields if not (isinstance(data.get(f), str) and data[f])]
 
 @app.route('/api/get-identity', methods=['GET'])
 def api_get_identity():
     try:
         logger.info("API: get-identity request received")
-        result = enqueue_and_wait("get_identity", {}, timeout=180)
-        return jsonify(result)
+        result = enqueue_and_wait("get_identity", {}, timeout=JOB_TIMEOUTS["get_identity"])
+        return _json(result)
+    except ServerBusy as e:
+        return _json({"success": False, "error": str(e)}, 503)
     except Exception as e:
         logger.error(f"get-identity endpoint error: {e}")
-        return jsonify({"success": False, "error": str(e)}), 500
+        return _json({"success": False, "error": str(e)}, 500)
 
 @app.route('/api/get-cw', methods=['POST'])
 def api_get_cw():
     try:
-        data = request.get_json()
-        if not data or "identity" not in data:
-            return jsonify({"success": False, "error": "Missing identity parameter"}), 400
+        data = request.get_json(force=True, silent=True, cache=False) or {}
+        if _missing_fields(data, ("identity",)):
+            return _raw_json(_MISSING_IDENTITY_BODY, 400)
         
         logger.info("API: get-cw request received")
-        result = enqueue_and_wait("get_cw", {"identity": data.get("identity")}, timeout=180)
-        return jsonify(result)
+        result = enqueue_and_wait("get_cw", {"identity": data.get("identity")}, timeout=JOB_TIMEOUTS["get_cw"])
+        return _json(result)
     except Exception as e:
         logger.error(f"get-cw endpoint error: {e}")
-        return jsonify({"success": False, "error": str(e)}), 500
+        return _json({"success": False, "error": str(e)}, 500)
 
 @app.route('/api/get-rw', methods=['POST'])
 def api_get_rw():
     try:
-        data = request.get_json()
-        if not data or "cw" not in data:
-            return jsonify({"success": False, "error": "Missing cw parameter"}), 400
+        data = request.get_json(force=True, silent=True, cache=False) or {}
+        if _missing_fields(data, ("cw",)):
+            return _raw_json(_MISSING_CW_BODY, 400)
         
         logger.info("API: get-rw request received")
-        result = enqueue_and_wait("get_rw", {"cw": data.get("cw")}, timeout=180)
-        return jsonify(result)
+        result = enqueue_and_wait("get_rw", {"cw": data.get("cw")}, timeout=JOB_TIMEOUTS["get_rw"])
+        return _json(result)
+    except ServerBusy as e:
+        return _json({"success": False, "error": str(e)}, 503)
     except Exception as e:
         logger.error(f"get-rw endpoint error: {e}")
-        return jsonify({"success": False, "error": str(e)}), 500
+        return _json({"success": False, "error": str(e)}, 500)
 
 @app.route('/api/authenticate', methods=['POST'])
 def api_authenticate():
     try:
-        data = request.get_json()
-        required_fields = ["identity", "cw", "rw", "transactionId"]
-        missing = [f for f in required_fields if f not in data]
+        data = request.get_json(force=True, silent=True, cache=False) or {}
+        missing = _missing_fields(data, ("identity", "cw", "rw", "transactionId"))
         if missing:
-            return jsonify({"success": False, "error": f"Missing parameters: {missing}"}), 400
+            return _json({"success": False, "error": f"Missing parameters: {missing}"}, 400)
         
         logger.info("API: authenticate request received")
-        result = enqueue_and_wait("authenticate", data, timeout=240)
-        return jsonify(result)
+        result = enqueue_and_wait("authenticate", data, timeout=JOB_TIMEOUTS["authenticate"])
+        return _json(result)
     except Exception as e:
         logger.error(f"authenticate endpoint error: {e}")
-        return jsonify({"success": False, "error": str(e)}), 500
+        return _json({"success": False, "error": str(e)}, 500)
 
 DEVICE_ID = os.getenv("DEVICE_ID", "Pi-Default")
-BROKER = "3.67.46.166"
+COMMAND_TOPIC = f"pi/{DEVICE_ID}/command"
+RESPONSE_TOPIC = f"pi/{DEVICE_ID}/response"
+PRESENCE_TOPIC = f"pi/{DEVICE_ID}/status"
+
+if orjson is not None:
+    # orjson works on bytes both ways: no decode on receive, no encode on publish
+    _encode_json = orjson.dumps
+    _decode_json = orjson.loads
+else:
+    # Built once: json.dumps only reuses its cached encoder for default options,
+    # and compact separators keep MQTT payloads small
+    _encode_json = json.JSONEncoder(separators=(",", ":")).encode
+    _decode_json = json.loads
+
+# Constant MQTT replies are serialized once
+_STATUS_PAYLOAD = _encode_json(status_logic())
+_UNKNOWN_FN_PAYLOAD = _encode_json({"success": False, "error": "Unknown function"})
+
+def _is_msgpack_map(data):
+    # fixmap / map16 / map32 markers; never the first byte of a JSON document
+    return bool(data) and (0x80 <= data[0] <= 0x8f or data[0] in (0xde, 0xdf))
+
+BROKER = os.getenv("MQTT_BROKER", "3.67.46.166")
+BROKER_PORT = int(os.getenv("MQTT_PORT", "1883"))
+# Broker drops us after 1.5x this with no traffic; paho pings when idle
+MQTT_KEEPALIVE = int(os.getenv("MQTT_KEEPALIVE", "30"))
+MQTT_QOS = 1
+
+# QoS 1 may redeliver a command after a reconnect; remember recent corrIds
+RECENT_CORR_IDS = 256
+_recent_corr_ids = OrderedDict()
+_recent_corr_lock = threading.Lock()
+
+def _already_seen(corr_id):
+    with _recent_corr_lock:
+        if corr_id in _recent_corr_ids:
+            return True
+        _recent_corr_ids[corr_id] = None
+        if len(_recent_corr_ids) > RECENT_CORR_IDS:
+            _recent_corr_ids.popitem(last=False)
+        return False
 
 def on_connect(client, userdata, flags, rc):
-    logger.info(f"[MQTT] Connected with result code {rc}")
-    client.subscribe(f"pi/{DEVICE_ID}/command")
+    logger.info("[MQTT] Connected with result code %s", rc)
+    client.publish(PRESENCE_TOPIC, "online", qos=1, retain=True)
+    # With a persistent session the broker kept the subscription; only a
+    # fresh session (first connect, or the broker lost it) needs it again
+    if not flags.get("session present"):
+        client.subscribe(COMMAND_TOPIC, qos=MQTT_QOS)
+
+def on_socket_open(client, userdata, sock):
+    # Replies are small and latency-sensitive; don't let Nagle hold them back
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (OSError, AttributeError):
+        pass
+
+# Several commands can be in flight at once; device jobs still serialize
+# in serial_worker, cloud-only ones run side by side
+_mqtt_executor = DaemonExecutor(max_workers=4, name="mqtt")
 
 def on_message(client, userdata, msg):
+    # Runs on paho's network thread; hand the command off so a long job
+    # never holds up keepalives or incoming messages
+    _mqtt_executor.submit(handle_mqtt_command, client, msg.payload)
+
+def handle_mqtt_command(client, raw):
+    corr_id = fn = None
+    # Commands may arrive as MessagePack; reply in the encoding they used
+    use_msgpack = msgpack is not None and _is_msgpack_map(raw)
     try:
-        payload = json.loads(msg.payload.decode())
+        if use_msgpack:
+            payload = msgpack.unpackb(raw)
+        else:
+            payload = _decode_json(raw)
+        corr_id = payload.get("corrId")
+        if corr_id is not None and _already_seen(corr_id):
+            logger.info("[MQTT] Ignoring redelivered command %s", corr_id)
+            return
         fn = payload.get("functionName")
         args = payload.get("args", [{}])
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("[MQTT] Received command %s args=%s", fn, args)
+
+        if corr_id is None and not use_msgpack:
+            if fn == "status":
+                client.publish(RESPONSE_TOPIC, _STATUS_PAYLOAD, qos=0)
+                return
+            if fn not in _DISPATCH:
+                client.publish(RESPONSE_TOPIC, _UNKNOWN_FN_PAYLOAD, qos=MQTT_QOS)
+                return
         
-        timeout_map = {
-            "status": 10,
-            "get_identity": 180,
-            "get_cw": 180,
-            "get_rw": 180,
-            "authenticate": 240
-        }
-        timeout = timeout_map.get(fn, 180)
-        
+        timeout = JOB_TIMEOUTS.get(fn, JOB_TIMEOUT)
         response = enqueue_and_wait(fn, args[0] if args else {}, timeout=timeout)
-        client.publish(f"pi/{DEVICE_ID}/response", json.dumps(response))
     except Exception as e:
-        error_response = {"success": False, "error": str(e)}
-        client.publish(f"pi/{DEVICE_ID}/response", json.dumps(error_response))
-
-def run_mqtt():
-    client = mqtt.Client()
+        response = {"success": False, "error": str(e)}
+
+    # Echo the caller's correlation id so one broker connection can carry
+    # several in-flight requests for this device
+    if corr_id is not None:
+        response["corrId"] = corr_id
+    encoded = msgpack.packb(response) if use_msgpack else _encode_json(response)
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("[MQTT] Publishing %r", encoded[:256])
+    # A lost status reply is cheaper to re-poll than to acknowledge
+    client.publish(RESPONSE_TOPIC, encoded, qos=0 if fn == "status" else MQTT_QOS)
+
+_mqtt_client = None
+
+def start_mqtt():
+    global _mqtt_client
+    # A fixed client id with clean_session=False keeps the subscription and
+    # queued QoS 1 commands on the broker across reconnects
+    client = mqtt.Client(client_id=DEVICE_ID, clean_session=False)
+    client.will_set(PRESENCE_TOPIC, "offline", qos=1, retain=True)
+    # paho's default window is 20 unacknowledged QoS 1 publishes. Replies
+    # queued during a broker outage are flushed on reconnect, and beyond the
+    # window each further batch waits a PUBACK round-trip
+    client.max_inflight_messages_set(100)
+    client.max_queued_messages_set(0)  # unbounded
     client.on_connect = on_connect
     client.on_message = on_message
-    
-    try:
-        client.connect(BROKER, 1883, 60)
-        logger.info("[MQTT] Starting loop")
-        client.loop_forever()
-    except Exception as e:
-        logger.error(f"[MQTT] Connection failed: {e}")
-
-threading.Thread(target=run_mqtt, daemon=True).start()
+    client.on_socket_open = on_socket_open
+    client.reconnect_delay_set(min_delay=1, max_delay=10)
+
+    # Non-blocking: paho connects, and reconnects, on its own network thread
+    client.connect_async(BROKER, BROKER_PORT, MQTT_KEEPALIVE)
+    client.loop_start()
+    _mqtt_client = client
+    atexit.register(stop_mqtt)
+    logger.info("[MQTT] Network loop started")
+
+def stop_mqtt():
+    if _mqtt_client:
+        # A clean disconnect suppresses the will, so report offline ourselves
+        _mqtt_client.publish(PRESENCE_TOPIC, "offline", qos=1, retain=True)
+        _mqtt_client.disconnect()
+        _mqtt_client.loop_stop()
+
+# Set RUN_MQTT=0 to import the app without opening a broker connection
+if os.getenv("RUN_MQTT", "1") == "1":
+    start_mqtt()
 
 def signal_handler(sig, frame):
     logger.info("\n[API] Shutting down gracefully...")
     sys.exit(0)
 
-signal.signal(signal.SIGINT, signal_handler)
-signal.signal(signal.SIGTERM, signal_handler)
-
 if __name__ == "__main__":
+    # Only when run directly: under gunicorn the master/worker own signals
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+
     print("=" * 70)
     print("Starting Pi API Server - ZERO FAILURE MODE")
     print("  - Operations NEVER fail, they retry until success")
@@ -395,4 +771,14 @@ if __name__ == "__main__":
     print("  - Automatic device reset on persistent failures")
     print("  - Very generous timeouts (3-5 minutes per operation)")
     print("=" * 70)
-    app.run(host="0.0.0.0", port=8000, debug=False, threaded=True)
\ No newline at end of file
+    # Prefer a production WSGI server; the handlers are I/O-bound, so a
+    # threaded server lets concurrent requests overlap their network waits.
+    # Under gunicorn use a single worker (the serial port, GPIO and MQTT
+    # client belong to one process): gunicorn -w 1 -k gthread --threads 8
+    # -b 0.0.0.0:8000 pi_api_server:app
+    try:
+        from waitress import serve
+        serve(app, host="0.0.0.0", port=8000, threads=8)
+    except ImportError:
+        logger.warning("waitress not installed - using the Flask development server")
+        app.run(host="0.0.0.0", port=8000, debug=False, threaded=True)
\ No newline at end of file
@@ -3,7 +3,11 @@ import websockets
 import socket
 import json
 import uuid
-import time
+import logging
+import os
+
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format='[%(asctime)s] %(levelname)s: %(message)s')
+logger = logging.getLogger(__name__)
 
 HUB_URL = "ws://192.168.1.162:9000"  
 DEVICE_ID = str(uuid.uuid4())
@@ -20,10 +24,16 @@ def get_local_ip():
         s.close()
     return ip
 
+RECONNECT_MAX_DELAY = 60
+
 async def register():
+    backoff = 1
     while True:
         try:
-            async with websockets.connect(HUB_URL) as ws:
+            # websockets pings every 20s and drops the connection if the hub
+            # stops answering, so there's no need to resend the payload
+            async with websockets.connect(HUB_URL, ping_interval=20, ping_timeout=10,
+                                          close_timeout=5) as ws:
                 info = {
                     "type": "register",
                     "deviceId": DEVICE_ID,
@@ -32,13 +42,13 @@ async def register():
                     "port": 5000,
                 }
                 await ws.send(json.dumps(info))
-                print("Registered to hub.")
-                while True:
-                    # keep connection alive
-                    await asyncio.sleep(30)
-                    await ws.send(json.dumps(info))
+                logger.info("Registered to hub.")
+                backoff = 1
+                await ws.wait_closed()
+                logger.warning("Hub connection closed, reconnecting in %ss", backoff)
         except Exception as e:
-            print("Retrying connection:", e)
-            time.sleep(5)
+            logger.warning("Retrying connection in %ss: %s", backoff, e)
+        await asyncio.sleep(backoff)
+        backoff = min(backoff * 2, RECONNECT_MAX_DELAY)
 
 asyncio.run(register())
@@ -1,13 +1,15 @@
-import random, sys, time, requests
+import atexit
+import functools
+import time, requests
 import serial
 import RPi.GPIO as GPIO
-from math import log, ceil
 import threading
 import glob
 from contextlib import contextmanager
 import logging
+import os
 
-logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s: %(message)s')
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format='[%(asctime)s] %(levelname)s: %(message)s')
 logger = logging.getLogger(__name__)
 
 # ==================== CONFIGURATION ====================
@@ -16,10 +18,10 @@ interface = 'USB'
 
 # OPTIMIZED FOR SPEED
 MAX_RETRIES = 2  # Reduced from 3
-INTER_REQUEST_DELAY = 0.1  # Reduced from 0.5s (80% faster!)
-DEVICE_SETTLE_TIME = 0.05  # Reduced from 0.2s
-BUFFER_CLEAR_DELAY = 0.01  # Reduced from 0.05s
-POST_OPERATION_DELAY = 0.05  # Reduced from 0.3s
+INTER_REQUEST_DELAY = 0.02  # Port stays open now; was 0.1s with open/close per call
+DEVICE_SETTLE_TIME = 0.05  # Reduced from 0.2s, applied when the port is opened
+RESPONSE_TIMEOUT = 3.0  # Covers device processing time plus transfer
+RESPONSE_MAX_BYTES = 512
 
 # API Endpoints
 if environment == 'SANDBOX':
@@ -28,6 +30,16 @@ if environment == 'SANDBOX':
     cyberrock_iot_replyrw = 'https://iot-api.sandbox.sandgrain.io/api/iot/replyRW'
     cyberrock_iot_checkstatus = 'https://iot-api.sandbox.sandgrain.io/api/iot/checkAuthStatus'
 
+# checkAuthStatus polling: first wait, backoff cap, and overall budget
+RESULT_POLL_INITIAL = 0.2
+RESULT_POLL_MAX = 2.0
+RESULT_POLL_TIMEOUT = 8.0
+
+# Shared HTTPS session: keeps the TLS connection to the CyberRock API alive
+# across the login / requestCW / replyRW / checkAuthStatus sequence
+_session = requests.Session()
+_session.mount('https://', requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
 # Command definitions
 l_command_ident = [0x01, 0x00, 0x00, 0x00]
 l_command_cr = [0x03, 0x00, 0x08, 0x00]
@@ -52,6 +64,7 @@ class DeviceConfig:
         self.total_operations = 0
         self.successful_operations = 0
         self.consecutive_failures = 0
+        self.ser = None  # opened on first use, kept open between transactions
 
 class DevicePool:
     _instance = None
@@ -104,132 +117,87 @@ _device_pool = DevicePool()
 # ==================== OPTIMIZED SERIAL COMMUNICATION ====================
 @contextmanager
 def exclusive_serial_access(device):
-    """Optimized for speed while maintaining safety"""
+    """Exclusive use of the device's serial port, opened once and kept open"""
     global _last_global_operation
     
-    _GLOBAL_SERIAL_LOCK.acquire()
-    
-    ser = None
-    try:
+    with _GLOBAL_SERIAL_LOCK:
         # Minimal delay between operations
         elapsed = time.time() - _last_global_operation
         if elapsed < INTER_REQUEST_DELAY:
             time.sleep(INTER_REQUEST_DELAY - elapsed)
         
-        # Open port
-        ser = serial.Serial(
-            port=device.serial_port,
-            baudrate=115200,
-            timeout=2.0,  # Reduced from 4.0
-            write_timeout=2.0,
-            exclusive=True,
-            inter_byte_timeout=0.1  # Reduced from 0.3
-        )
-        
-        # Minimal settling time
-        time.sleep(DEVICE_SETTLE_TIME)
-        
-        # Single buffer clear (not 3 rounds!)
-        ser.reset_input_buffer()
-        ser.reset_output_buffer()
-        time.sleep(BUFFER_CLEAR_DELAY)
-        
-        yield ser
-        
-    finally:
-        if ser and ser.is_open:
-            try:
-                ser.reset_input_buffer()
-                ser.reset_output_buffer()
-                ser.close()
-            except Exception as e:
-                logger.error(f"Error closing port: {e}")
-        
-        _last_global_operation = time.time()
-        
-        # Minimal cool-down
-        time.sleep(POST_OPERATION_DELAY)
-        
-        _GLOBAL_SERIAL_LOCK.release()
-
-def read_response_robust(ser, expected_bytes=144, timeout=3.0):
-    """Faster response reading with lower timeout"""
-    response = b''
-    start_time = time.time()
-    last_data_time = start_time
-    consecutive_empty_reads = 0
-    max_empty_reads = 3  # Reduced from 5
-    
-    while time.time() - start_time < timeout:
         try:
-            waiting = ser.in_waiting
+            if device.ser is None:
+                device.ser = serial.Serial(
+                    port=device.serial_port,
+                    baudrate=115200,
+                    timeout=RESPONSE_TIMEOUT,
+                    write_timeout=2.0,
+                    exclusive=True,
+                    inter_byte_timeout=0.1  # Reduced from 0.3
+                )
+                # Settling is only needed right after the port opens
+                time.sleep(DEVICE_SETTLE_TIME)
             
-            if waiting > 0:
-                chunk = ser.read(waiting)
-                
-                if len(chunk) > 0:
-                    response += chunk
-                    last_data_time = time.time()
-                    consecutive_empty_reads = 0
-                    
-                    if len(response) >= expected_bytes:
-                        break
-                else:
-                    consecutive_empty_reads += 1
-                    
-                    if consecutive_empty_reads >= max_empty_reads:
-                        if len(response) > 0:
-                            break
-                        else:
-                            raise Exception("Device stuck - no data")
-                    
-                    time.sleep(0.05)  # Reduced from 0.15
-            else:
-                if len(response) > 0:
-                    stall_time = time.time() - last_data_time
-                    if stall_time > 0.5:  # Reduced from 1.0
-                        if len(response) >= expected_bytes * 0.6:
-                            break
-                
-                time.sleep(0.02)  # Reduced from 0.03
+            ser = device.ser
+            # Drop anything left over from the previous transaction
+            ser.reset_input_buffer()
+            ser.reset_output_buffer()
+            
+            yield ser
             
-        except serial.SerialException as e:
-            logger.error(f"Serial exception: {e}")
-            if len(response) > 0:
-                break
+        except Exception:
+            # The port may be wedged or unplugged; reopen it on the next use
+            close_device(device)
             raise
+        
+        finally:
+            _last_global_operation = time.time()
+
+def close_device(device):
+    ser, device.ser = device.ser, None
+    if ser is not None:
+        try:
+            ser.close()
+        except Exception as e:
+            logger.error(f"Error closing port: {e}")
+
+@atexit.register
+def close_all_devices():
+    for device in _device_pool.devices:
+        close_device(device)
+
+def read_response(ser, max_bytes=RESPONSE_MAX_BYTES):
+    """Block until the device's CR-terminated response line arrives"""
+    start_time = time.time()
+    # Returns on the terminator, at max_bytes, or when ser.timeout runs out
+    response = ser.read_until(b'\r', size=max_bytes)
     
     if len(response) == 0:
         raise Exception(f"No response after {time.time() - start_time:.1f}s")
     
     return response
 
+# Every byte value that is not an ASCII hex digit, for bytes.translate
+_NON_HEX = bytes(sorted(set(range(256)) - set(b'0123456789abcdefABCDEF')))
+
 def parse_hex_response(response_bytes):
     """Parse hex response"""
-    try:
-        response_str = response_bytes.decode('utf-8', errors='ignore').strip()
-    except:
-        response_str = response_bytes.decode('ascii', errors='ignore').strip()
-    
-    hex_chars = ''.join(c for c in response_str if c in '0123456789abcdefABCDEF')
+    # Drop CR/LF and any line noise in one C-level pass
+    hex_chars = response_bytes.translate(None, _NON_HEX).decode('ascii')
     
     if len(hex_chars) < 20:
         raise Exception(f"Invalid response: only {len(hex_chars)} hex chars")
     
-    byte_list = []
-    for i in range(0, len(hex_chars) - 1, 2):
-        try:
-            byte_list.append(int(hex_chars[i:i+2], 16))
-        except ValueError:
-            continue
+    response = bytes.fromhex(hex_chars[:len(hex_chars) & ~1])
     
-    if len(byte_list) < 10:
-        raise Exception(f"Parsed response too short: {len(byte_list)} bytes")
+    if len(response) < 10:
+        raise Exception(f"Parsed response too short: {len(response)} bytes")
     
-    return byte_list
+    return response
 
-def do_ser_transfer_l(l):
-    """Optimized serial transfer"""
+def do_ser_transfer(cmd):
+    """Optimized serial transfer of a wire-encoded command (see assemble_*)"""
     if not _device_pool.initialized:
         _device_pool.initialize()
     
@@ -240,32 +208,22 @@ def do_ser_transfer_l(l):
         try:
             with exclusive_serial_access(device) as ser:
                 # Send command
-                cmd = ''.join('%02x' % e for e in l) + "\r"
-                ser.write(cmd.encode('utf-8'))
+                ser.write(cmd)
                 ser.flush()
                 
-                # Optimized processing time
-                if l[0] == 0x01:  # Identity
-                    process_time = 0.15  # Reduced from 0.35
-                elif l[0] == 0x03:  # Challenge-response
-                    process_time = 0.20  # Reduced from 0.40
-                else:
-                    process_time = 0.15
-                
-                time.sleep(process_time)
-                
-                # Read with shorter timeout
-                response_bytes = read_response_robust(ser, expected_bytes=144, timeout=3.0)
+                # No fixed processing delay: the read blocks in the tty
+                # layer and returns as soon as the response line is in
+                response_bytes = read_response(ser)
                 
                 # Parse
-                byte_list = parse_hex_response(response_bytes)
+                response = parse_hex_response(response_bytes)
                 
                 # Success!
                 device.consecutive_failures = 0
                 device.successful_operations += 1
                 device.total_operations += 1
                 
-                return byte_list
+                return response
                 
         except Exception as e:
             last_error = e
@@ -280,84 +238,112 @@ def do_ser_transfer_l(l):
     
     raise Exception(f"Transfer failed after {MAX_RETRIES} attempts. Last error: {last_error}")
 
+def do_ser_transfer_l(l):
+    """Serial transfer of a frame given as a list of ints"""
+    return do_ser_transfer((bytes(l).hex() + "\r").encode())
+
+do_transfer = do_ser_transfer
 do_transfer_l = do_ser_transfer_l
 
 # ==================== HELPER FUNCTIONS ====================
 def intToList(number):
-    L1 = log(number, 256)
-    L2 = ceil(L1)
-    if L1 == L2:
-        L2 += 1
-    return [(number & (0xff << 8*i)) >> 8*i for i in reversed(range(L2))]
+    return list(number.to_bytes((number.bit_length() + 7) // 8 or 1, 'big'))
 
 # ==================== COMMAND ASSEMBLY ====================
+# Commands go over the wire as lowercase hex terminated by CR. The identity
+# frame is constant and the challenge frame only varies in the middle, so
+# the fixed parts are encoded once here
+_ID_CMD = (bytes(l_command_ident + [0] + [0]*32).hex() + "\r").encode()
+_CR_PREFIX = bytes(l_command_cr + [0]).hex().encode()
+_CR_SUFFIX = (bytes([0] + [0]*49).hex() + "\r").encode()
+
+def assemble_id_cmd():
+    return _ID_CMD
+
+def assemble_cw_cmd(challenge):
+    # challenge may be any byte sequence (list of ints or bytes)
+    return _CR_PREFIX + bytes(challenge).hex().encode() + _CR_SUFFIX
+
+# List-frame forms, for do_ser_transfer_l
 def assemble_id_l():
     return l_command_ident + [0] + [0]*32
 
 def assemble_cw_l(l_challenge):
-    return l_command_cr + [0] + l_challenge + [0] + [0]*49
+    return l_command_cr + [0] + list(l_challenge) + [0] + [0]*49
 
 # ==================== RESPONSE DISASSEMBLY ====================
+# Slices are memoryviews into the response: no copies, and .hex() works on them
 def disassemble_l_id(l_r):
     if len(l_r) < API_I_IDENT_PART2_START + API_I_IDENT_PART2_LENGTH:
         raise Exception(f"Response too short: {len(l_r)} bytes")
     
-    l_pcc = l_r[API_I_IDENT_PART1_START : API_I_IDENT_PART1_START + API_I_IDENT_PART1_LENGTH]
-    l_id = l_r[API_I_IDENT_PART2_START : API_I_IDENT_PART2_START + API_I_IDENT_PART2_LENGTH]
+    view = memoryview(l_r)
+    l_pcc = view[API_I_IDENT_PART1_START : API_I_IDENT_PART1_START + API_I_IDENT_PART1_LENGTH]
+    l_id = view[API_I_IDENT_PART2_START : API_I_IDENT_PART2_START + API_I_IDENT_PART2_LENGTH]
     return l_pcc, l_id
 
 def disassemble_l_rw(l_r):
     if len(l_r) < API_I_RESP_START + API_I_RESP_LENGTH:
         raise Exception(f"Response too short: {len(l_r)} bytes")
     
-    l_pcc = l_r[API_I_IDENT_PART1_START : API_I_IDENT_PART1_START + API_I_IDENT_PART1_LENGTH]
-    l_id = l_r[API_I_IDENT_PART2_START : API_I_IDENT_PART2_START + API_I_IDENT_PART2_LENGTH]
-    l_rw = l_r[API_I_RESP_START : API_I_RESP_START + API_I_RESP_LENGTH]
+    view = memoryview(l_r)
+    l_pcc = view[API_I_IDENT_PART1_START : API_I_IDENT_PART1_START + API_I_IDENT_PART1_LENGTH]
+    l_id = view[API_I_IDENT_PART2_START : API_I_IDENT_PART2_START + API_I_IDENT_PART2_LENGTH]
+    l_rw = view[API_I_RESP_START : API_I_RESP_START + API_I_RESP_LENGTH]
     return l_pcc, l_id, l_rw
 
 # ==================== DEVICE OPERATIONS ====================
 def get_pccid():
     """Get PCCID from device"""
-    logger.info(">>> get_pccid() called")
-    l_r = do_transfer_l(assemble_id_l())
+    logger.debug(">>> get_pccid() called")
+    l_r = do_transfer(assemble_id_cmd())
     l_pcc, l_id = disassemble_l_id(l_r)
     
-    s_pcc = ''.join('%02x' % e for e in l_pcc)
-    s_id = ''.join('%02x' % e for e in l_id)
-    result = s_pcc + s_id
+    result = l_pcc.hex() + l_id.hex()
     
-    logger.info(f"<<< get_pccid() returning: {result}")
+    logger.debug("<<< get_pccid() returning: %s", result)
     return result
 
 def do_rw_only(cw_l):
     """Get RW response"""
-    logger.info(">>> do_rw_only() called")
-    l_r = do_transfer_l(assemble_cw_l(cw_l))
+    logger.debug(">>> do_rw_only() called")
+    l_r = do_transfer(assemble_cw_cmd(cw_l))
     l_pcc, l_id, l_rw = disassemble_l_rw(l_r)
     
-    s_rw = ''.join('%02x' % e for e in l_rw)
-    logger.info(f"<<< do_rw_only() returning: {s_rw}")
+    s_rw = l_rw.hex()
+    logger.debug("<<< do_rw_only() returning: %s", s_rw)
     return s_rw
 
 # ==================== CYBERROCK API ====================
-def do_cyberrock_iot_login(cloudflaretokens, iotusername, iotpassword):
-    response = requests.post(cyberrock_iot_login,
-        headers=cloudflaretokens,
+def set_cloudflare_tokens(cloudflaretokens):
+    """Attach the Cloudflare Access headers to every CyberRock request"""
+    _session.headers.update(cloudflaretokens)
+
+@functools.lru_cache(maxsize=4)
+def _auth_headers(accesstoken):
+    # One dict per token, reused by every call and poll made with it;
+    # requests merges it into a fresh dict and never modifies it
+    return {'Authorization': 'Bearer ' + accesstoken}
+
+def do_cyberrock_iot_login(iotusername, iotpassword):
+    response = _session.post(cyberrock_iot_login,
         data={'username': iotusername, 'password': iotpassword},
         timeout=10)  # Reduced from 15
+    response.raise_for_status()
     logindata = response.json()
     return logindata['accessToken'], logindata['iotId']
 
-def get_cyberrock_cw(cloudflaretokens, accesstoken, PCCID, requestSignature):
-    data_auth = cloudflaretokens | {'Authorization': 'Bearer ' + accesstoken}
+def get_cyberrock_cw(accesstoken, PCCID, requestSignature):
+    data_auth = _auth_headers(accesstoken)
     data_post = {"requestSignedResponse": requestSignature, "PCCID": PCCID}
-    response = requests.post(cyberrock_iot_requestcw,
+    response = _session.post(cyberrock_iot_requestcw,
         headers=data_auth, json=data_post, timeout=10)
+    response.raise_for_status()
     cwdata = response.json()
     return cwdata['CW'], cwdata['transactionId']
 
-def do_submit_rw(cloudflaretokens, accesstoken, PCCID, CW, RW, transactionid, requestSignature):
-    data_auth = cloudflaretokens | {'Authorization': 'Bearer ' + accesstoken}
+def do_submit_rw(accesstoken, PCCID, CW, RW, transactionid, requestSignature):
+    data_auth = _auth_headers(accesstoken)
     data_post = {
         "requestSignedResponse": requestSignature,
         "PCCID": PCCID,
@@ -365,26 +351,34 @@ def do_submit_rw(cloudflaretokens, accesstoken, PCCID, CW, RW, transactionid, re
         "RW": RW,
         "transactionId": transactionid
     }
-    response = requests.post(cyberrock_iot_replyrw,
+    response = _session.post(cyberrock_iot_replyrw,
         headers=data_auth, json=data_post, timeout=10)
+    response.raise_for_status()
     return response.json()['transactionId']
 
-def do_retrieve_result(cloudflaretokens, accesstoken, transactionid, requestSignature):
-    data_auth = cloudflaretokens | {'Authorization': 'Bearer ' + accesstoken}
+def do_retrieve_result(accesstoken, transactionid, requestSignature):
+    data_auth = _auth_headers(accesstoken)
     params_post = {"transactionId": transactionid}
     data_post = {"requestSignedResponse": requestSignature}
     
-    authenticationresult = 'NOT_READY'
-    max_attempts = 40
-    attempt = 0
+    # Poll quickly at first, then back off: most results are ready within
+    # a few hundred ms, slow ones don't need 5 requests a second
+    deadline = time.monotonic() + RESULT_POLL_TIMEOUT
+    delay = RESULT_POLL_INITIAL
     
-    while authenticationresult == 'NOT_READY' and attempt < max_attempts:
-        time.sleep(0.2)  # Reduced from 0.3
-        response = requests.get(cyberrock_iot_checkstatus,
+    while True:
+        time.sleep(delay)
+        response = _session.get(cyberrock_iot_checkstatus,
             headers=data_auth, params=params_post, json=data_post, timeout=10)
+        response.raise_for_status()
         responsedata = response.json()
         authenticationresult = responsedata['status']
-        attempt += 1
+        if authenticationresult != 'NOT_READY':
+            break
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        delay = min(delay * 1.5, RESULT_POLL_MAX, remaining)
     
     claimid = responsedata.get('claimId', '') if authenticationresult == 'CLAIM_ID' else ''
     return authenticationresult, claimid
@@ -399,6 +393,6 @@ def gpio_setup():
 
 gpio_setup()
 logger.info(f"SGA Module loaded - SPEED OPTIMIZED")
-logger.info(f"Inter-request delay: {INTER_REQUEST_DELAY}s (80% faster!)")
+logger.info(f"Inter-request delay: {INTER_REQUEST_DELAY}s")
 logger.info(f"Device settle time: {DEVICE_SETTLE_TIME}s")
 logger.info(f"Max retries: {MAX_RETRIES}")
\ No newline at end of file